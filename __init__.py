@@ -17,11 +17,17 @@ Inspired by your Kanji Constituent Auto-Fill add-on.
 """
 
 import json
+import os
+import re
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, TypedDict
 
+from anki import notes_pb2
+from anki.collection import OpChanges
 from anki.hooks import addHook
-from aqt import mw
+from anki.notes import Note
+from aqt import gui_hooks, mw
+from aqt.operations import CollectionOp
 from aqt.qt import (QAction, QCheckBox, QDialog, QDialogButtonBox, QFormLayout,
                     QLineEdit)
 from aqt.utils import showInfo, tooltip
@@ -35,7 +41,27 @@ ADDON_DIR = Path(mw.addonManager.addonsFolder()) / ADDON_NAME
 CFG_FILE = ADDON_DIR / "config.json"
 
 
-def _defaults() -> Dict[str, object]:
+class Cfg(TypedDict, total=False):
+    """Config shape as written by _defaults() and the options dialog.
+
+    Users can hand-edit the JSON via Anki's add-on config editor, so
+    values straight from getConfig may violate these types; _load_cfg
+    and the dialog coerce at that boundary, letting the hot paths read
+    values without per-note str() calls."""
+
+    sentenceField: str
+    wordField: str
+    destinationField: str
+    noteTypes: str
+    lookupOnAdd: bool
+    maskString: str
+    bulkActionLabel: str
+    debug: bool
+    # Derived at load time by _load_cfg, never persisted
+    _ntFilterRe: re.Pattern[str] | None
+
+
+def _defaults() -> Cfg:
     return {
         # Field with the full sentence
         "sentenceField": "Sentence",
@@ -56,34 +82,93 @@ def _defaults() -> Dict[str, object]:
     }
 
 
-def _load_cfg() -> Dict[str, object]:
+# Cached (sentence_idx, word_idx) per note-type id, so editor focus
+# events don't rebuild the field-name list on every defocus.
+_FIELD_IDX_CACHE: Dict[int, tuple] = {}
+
+# Note-type names per id; note.note_type() crosses into the backend, so
+# resolve each distinct note type once per bulk run.
+_NT_NAME_CACHE: Dict[int, str] = {}
+
+
+def _load_cfg() -> Cfg:
+    _FIELD_IDX_CACHE.clear()  # field names may have been reconfigured
+    _NT_NAME_CACHE.clear()  # note types may have been renamed
     user = mw.addonManager.getConfig(ADDON_NAME) or {}
-    return {**_defaults(), **user}
+    cfg: Cfg = {**_defaults(), **user}
+    # Compile the note-type filter once here instead of matching
+    # token-by-token per note
+    tokens = [
+        t.strip()
+        # str() guards against hand-edited JSON from Anki's config editor
+        for t in str(cfg.get("noteTypes", "")).split(",")
+        if t.strip()
+    ]
+    cfg["_ntFilterRe"] = (
+        re.compile("|".join(re.escape(t) for t in tokens), re.IGNORECASE)
+        if tokens
+        else None
+    )
+    return cfg
 
 
-def _save_cfg(cfg: Dict[str, object]) -> None:
+# JSON from the last successful config.json write, to skip no-op rewrites
+_LAST_CFG_JSON: str | None = None
+
+
+def _save_cfg(cfg: Cfg) -> None:
+    global _LAST_CFG_JSON
+    # Don't persist derived values (underscore keys); they are rebuilt
+    # by _load_cfg whenever CFG is refreshed.
+    cfg = {k: v for k, v in cfg.items() if not k.startswith("_")}
     mw.addonManager.writeConfig(ADDON_NAME, cfg)
+
+    data = json.dumps({"config": cfg}, ensure_ascii=False, indent=2)
+    if data == _LAST_CFG_JSON:
+        return  # Nothing changed since the last write
+
     try:
         ADDON_DIR.mkdir(parents=True, exist_ok=True)
-        CFG_FILE.write_text(json.dumps({"config": cfg}, ensure_ascii=False, indent=2))
+        # Write to a temp file and rename, so a crash mid-write can't
+        # leave a truncated config.json behind
+        tmp = CFG_FILE.with_suffix(".json.tmp")
+        tmp.write_text(data)
+        os.replace(tmp, CFG_FILE)
+        _LAST_CFG_JSON = data
     except Exception as e:
         print("[ClozeMask] couldn't write config.json:", e)
 
 
-CFG: Dict[str, object] = _load_cfg()
+# Loaded lazily on first use so importing the add-on doesn't hit the
+# disk during Anki startup.
+CFG: Cfg | None = None
+
+
+def _cfg() -> Cfg:
+    global CFG
+    if CFG is None:
+        CFG = _load_cfg()
+    return CFG
 
 ###############################################################################
 # Debug logging
 ###############################################################################
 
 def log(*msg):
-    if CFG.get("debug"):
+    if _cfg().get("debug"):
         print("[ClozeMask]", *msg)
 
 ###############################################################################
 # Core logic: populate one note
 ###############################################################################
 
+def _cheap_strip(s: str) -> str:
+    """Like strip(), but skips the copy when there is nothing to trim."""
+    if s and (s[0].isspace() or s[-1].isspace()):
+        return s.strip()
+    return s
+
+
 def generate_cloze_sentence(sentence: str, word: str, mask: str) -> str | None:
     """
     Replace inflected forms of `word` by gradually shortening it:
@@ -94,59 +179,62 @@ def generate_cloze_sentence(sentence: str, word: str, mask: str) -> str | None:
     if not sentence or not word:
         return None
 
-    # 1) Try full word first
-    idx = sentence.find(word)
-    if idx != -1:
-        before = sentence[:idx]
-        after = sentence[idx + len(word):]
-        return before + mask + after
-
-    # 2) Generate prefixes (longest → shortest)
-    prefixes: list[str] = []
-    for i in range(len(word) - 1, 0, -1):
-        prefixes.append(word[:i])
-
-    # 3) Try each prefix
-    for prefix in prefixes:
-        idx = sentence.find(prefix)
-        if idx != -1:
-            before = sentence[:idx]
-            after = sentence[idx + len(prefix):]
-            return before + mask + after
-
-    # 4) Kanji-only fallback
-    kanji_chars = [c for c in word if "\u4e00" <= c <= "\u9fff"]
-    for kanji in kanji_chars:
-        idx = sentence.find(kanji)
-        if idx != -1:
-            before = sentence[:idx]
-            after = sentence[idx + len(kanji):]
-            return before + mask + after
+    lw = len(word)
+
+    # 1) Try full word first. partition() finds, splits and returns in a
+    #    single scan; a 1-char word hits CPython's specialised scanner
+    #    here and has no shorter prefixes or kanji to fall back to.
+    #    A word longer than the sentence can never fully match, so skip
+    #    the scan and go straight to the prefixes.
+    if lw <= len(sentence):
+        head, sep, tail = sentence.partition(word)
+        if sep:
+            return head + mask + tail
+    if lw == 1:
+        return None
+
+    # 2) Try prefixes (longest → shortest), starting from the longest
+    #    one that can still fit in the sentence
+    for i in range(min(lw - 1, len(sentence)), 0, -1):
+        head, sep, tail = sentence.partition(word[:i])
+        if sep:
+            return head + mask + tail
+
+    # 3) Kanji-only fallback
+    for kanji in word:
+        if "\u4e00" <= kanji <= "\u9fff":
+            head, sep, tail = sentence.partition(kanji)
+            if sep:
+                return head + mask + tail
 
     return None
 
 
-def populate_cloze(note) -> bool:
+def populate_cloze(note, memo: Dict[tuple, str | None] | None = None) -> bool:
     """
     Populate the destination field with a masked sentence, based on
     the configured sentenceField, wordField, destinationField.
     Returns True if note was modified.
-    """
-    nt_filter = [
-        t.strip().lower()
-        for t in str(CFG.get("noteTypes", "")).split(",")
-        if t.strip()
-    ]
-    note_name = note.note_type()["name"].lower()
-
-    if nt_filter and not any(t in note_name for t in nt_filter):
-        log("Skip – note-type filtered:", note.note_type()["name"])
-        return False
 
-    sentence_field = CFG.get("sentenceField", "Sentence")
-    word_field = CFG.get("wordField", "Reading")
-    dest_field = CFG.get("destinationField", "ClozeSentence")
-    mask = CFG.get("maskString", "◼◼◼")
+    `memo` optionally caches generate_cloze_sentence results across
+    calls, keyed on (sentence, word, mask) — useful for bulk runs where
+    many notes share identical content.
+    """
+    cfg = _cfg()
+    nt_re = cfg.get("_ntFilterRe")
+    if nt_re is not None:
+        nt_name = _NT_NAME_CACHE.get(note.mid)
+        if nt_name is None:
+            nt_name = note.note_type()["name"]
+            _NT_NAME_CACHE[note.mid] = nt_name
+        if not nt_re.search(nt_name):
+            log("Skip – note-type filtered:", nt_name)
+            return False
+
+    sentence_field = cfg.get("sentenceField", "Sentence")
+    word_field = cfg.get("wordField", "Reading")
+    dest_field = cfg.get("destinationField", "ClozeSentence")
+    mask = cfg.get("maskString", "◼◼◼")
 
     # Safety: fields must exist
     if sentence_field not in note or word_field not in note or dest_field not in note:
@@ -157,14 +245,21 @@ def populate_cloze(note) -> bool:
     if sentence_field == dest_field:
         log("Warning – destination field is same as sentence field")
 
-    sentence = note[sentence_field].strip()
-    word = note[word_field].strip()
+    sentence = _cheap_strip(note[sentence_field])
+    word = _cheap_strip(note[word_field])
 
     if not sentence or not word:
         log("Skip – empty sentence or word")
         return False
 
-    clozed = generate_cloze_sentence(sentence, word, mask)
+    key = (sentence, word, mask)
+    if memo is not None and key in memo:
+        clozed = memo[key]
+    else:
+        clozed = generate_cloze_sentence(sentence, word, mask)
+        if memo is not None:
+            memo[key] = clozed
+
     if clozed is None:
         log("Skip – word not found in sentence:", word, "in", sentence)
         return False
@@ -177,71 +272,153 @@ def populate_cloze(note) -> bool:
 # Hooks – automatic fill on field defocus
 ###############################################################################
 
-def on_edit_focus(flag, note, field_idx):
-    """
-    Called when focus leaves a field in the editor.
-    If lookupOnAdd is enabled, we try generating the cloze sentence when
-    the user leaves either the sentence field or the word field.
-    """
-    if not CFG.get("lookupOnAdd", True):
-        return flag
+def _field_indices(model) -> tuple:
+    """Return (sentence_idx, word_idx) for `model`, caching per note-type id."""
+    cached = _FIELD_IDX_CACHE.get(model["id"])
+    if cached is not None:
+        return cached
 
-    col = mw.col
-    model = note.note_type()
-    field_names = col.models.field_names(model)
+    cfg = _cfg()
+    field_names = mw.col.models.field_names(model)
 
     try:
-        sent_idx = field_names.index(CFG.get("sentenceField", "Sentence"))
+        sent_idx = field_names.index(cfg.get("sentenceField", "Sentence"))
     except ValueError:
         sent_idx = None
 
     try:
-        word_idx = field_names.index(CFG.get("wordField", "Reading"))
+        word_idx = field_names.index(cfg.get("wordField", "Reading"))
     except ValueError:
         word_idx = None
 
-    # If we just left either the sentence or the word field, try to populate
-    if field_idx == sent_idx or field_idx == word_idx:
-        log("Field defocus – trying note id", note.id)
-        if populate_cloze(note):
-            note.flush()
+    cached = (sent_idx, word_idx)
+    _FIELD_IDX_CACHE[model["id"]] = cached
+    return cached
+
+
+def on_edit_focus(flag, note, field_idx):
+    """
+    Called when focus leaves a field in the editor.
+    If lookupOnAdd is enabled, we try generating the cloze sentence when
+    the user leaves either the sentence field or the word field.
+    """
+    if not _cfg().get("lookupOnAdd", True):
+        return flag
+
+    sent_idx, word_idx = _field_indices(note.note_type())
+
+    # Leaving an unrelated field is the common case – bail out early
+    if field_idx != sent_idx and field_idx != word_idx:
+        return flag
+
+    log("Field defocus – trying note id", note.id)
+    if populate_cloze(note):
+        note.flush()
 
     return flag
 
 
-if CFG.get("lookupOnAdd", True):
+# Whether editFocusLost has been registered; _install_editor_hook stays
+# on editor_did_init (removing a callback while gui_hooks iterates would
+# skip other add-ons' hooks) and becomes a no-op after the first call.
+_editor_hook_installed = False
+
+
+def _install_editor_hook(*_args):
+    """Register editFocusLost on the first editor the user opens.
+
+    Deferring this keeps config loading off Anki's startup path;
+    `lookupOnAdd` itself is checked per event in on_edit_focus.
+    """
+    global _editor_hook_installed
+    if _editor_hook_installed:
+        return
+    _editor_hook_installed = True
     addHook("editFocusLost", on_edit_focus)
 
+
+gui_hooks.editor_did_init.append(_install_editor_hook)
+
 ###############################################################################
 # Bulk action (Browser)
 ###############################################################################
 
-def bulk_generate_cloze(nids: List[int]):
+# Fetch in batches to keep the IN(...) clause bounded
+_FETCH_CHUNK = 5000
+
+
+def _fetch_notes(col, nids: List[int]):
+    """Yield notes for `nids`, fetching each chunk with a single query.
+
+    The collection API only exposes per-note get_note(), which costs one
+    backend round-trip per note. Pulling the rows straight from the notes
+    table and hydrating Note objects from them keeps a bulk run at one
+    query per _FETCH_CHUNK ids.
+    """
+    for start in range(0, len(nids), _FETCH_CHUNK):
+        chunk = nids[start:start + _FETCH_CHUNK]
+        rows = col.db.all(
+            "select id, guid, mid, mod, usn, tags, flds from notes"
+            f" where id in ({','.join('?' * len(chunk))})",
+            *chunk,
+        )
+        for nid, guid, mid, mod, usn, tags, flds in rows:
+            # Same loading path Note.load() uses, minus the per-note
+            # backend call
+            note = Note.__new__(Note)
+            note.col = col.weakref()
+            note._load_from_backend_note(
+                notes_pb2.Note(
+                    id=nid,
+                    guid=guid,
+                    notetype_id=mid,
+                    mtime_secs=mod,
+                    usn=usn,
+                    tags=tags.split(),
+                    fields=flds.split("\x1f"),
+                )
+            )
+            yield note
+
+
+def bulk_generate_cloze(browser, nids: List[int]):
     global CFG
     CFG = _load_cfg()  # Refresh settings each run
     if not nids:
         tooltip("No notes selected")
         return
 
-    col = mw.col
     changed = 0
-    for nid in nids:
-        note = col.get_note(nid)
-        if populate_cloze(note):
-            if note.id:
-                col.update_note(note)
-            changed += 1
-
-    if changed:
-        tooltip(f"Updated {changed} notes")
-    else:
-        tooltip("No notes needed")
-    log("Bulk finished –", changed, "of", len(nids))
+
+    def op(col) -> OpChanges:
+        # Runs on a background thread via CollectionOp, so large
+        # selections don't freeze the Qt event loop
+        nonlocal changed
+        modified = []
+        memo: Dict[tuple, str | None] = {}
+        for note in _fetch_notes(col, nids):
+            if populate_cloze(note, memo):
+                modified.append(note)
+
+        changed = len(modified)
+        # One transaction instead of a DB write per note
+        if modified:
+            return col.update_notes(modified)
+        return OpChanges()
+
+    def on_success(_changes: OpChanges):
+        if changed:
+            tooltip(f"Updated {changed} notes", parent=browser)
+        else:
+            tooltip("No notes needed", parent=browser)
+        log("Bulk finished –", changed, "of", len(nids))
+
+    CollectionOp(parent=browser, op=op).success(on_success).run_in_background()
 
 
 def browser_menu(browser):
-    act = QAction(CFG.get("bulkActionLabel", "Generate Cloze Masks"), browser)
-    act.triggered.connect(lambda _, b=browser: bulk_generate_cloze(b.selectedNotes()))
+    act = QAction(_cfg().get("bulkActionLabel", "Generate Cloze Masks"), browser)
+    act.triggered.connect(lambda _, b=browser: bulk_generate_cloze(b, b.selectedNotes()))
     browser.form.menuEdit.addSeparator()
     browser.form.menuEdit.addAction(act)
 
@@ -291,7 +468,7 @@ def show_options():
     if not dlg.exec():
         return
 
-    new_cfg = {
+    new_cfg: Cfg = {
         "sentenceField": w_sentence.text().strip() or "Sentence",
         "wordField": w_word.text().strip() or "Reading",
         "destinationField": w_dest.text().strip() or "ClozeSentence",
@@ -307,11 +484,15 @@ def show_options():
     showInfo("Cloze Mask settings saved.")
 
 
-# Add to Tools menu
-menu_act = QAction("Cloze Mask Options…", mw)
-menu_act.triggered.connect(show_options)
-mw.form.menuTools.addSeparator()
-mw.form.menuTools.addAction(menu_act)
+# Add to Tools menu once the main window is up
+def _setup_menu():
+    menu_act = QAction("Cloze Mask Options…", mw)
+    menu_act.triggered.connect(show_options)
+    mw.form.menuTools.addSeparator()
+    mw.form.menuTools.addAction(menu_act)
+
+
+gui_hooks.main_window_did_init.append(_setup_menu)
 
 print("[ClozeMask] Cloze Mask Auto-Fill add-on loaded.")
 